@@ -1,21 +1,60 @@
 # admin_utils.py
+import pandas as pd
 import streamlit as st
-from db_utils import conn, get_cursor
+from db_utils import conn, get_cursor, get_connection, set_settings
 from auth_utils import hash_password, login_form, register_form
+from quota_utils import get_limits, update_limits
+from helper_utils import get_history_retention
 import sqlite3
 import os
 
-def update_admin_status(user_id, is_admin):
+# Admin tables are read one page at a time; totals come from cached counts
+PAGE_SIZES = [25, 50, 100]
+USER_SORTS = {
+    "Username": "username",
+    "Newest first": "created_at DESC, id DESC",
+    "Admins first": "is_admin DESC, username",
+}
+
+def apply_user_changes(admin_updates, deleted_ids):
+    """Apply admin flag changes and deletions from one page in a single transaction."""
+    with get_cursor() as c:
+        c.executemany('UPDATE users SET is_admin = ? WHERE id = ?',
+                      [(int(is_admin), user_id) for user_id, is_admin in admin_updates])
+        c.executemany('DELETE FROM api_keys WHERE username = (SELECT username FROM users WHERE id = ?)',
+                      [(user_id,) for user_id in deleted_ids])
+        c.executemany('DELETE FROM users WHERE id = ?', [(user_id,) for user_id in deleted_ids])
+    count_rows.clear()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def count_rows(table, where="1", params=()):
+    """Row count for a filtered admin table, cached between reruns."""
     with get_cursor() as c:
-        c.execute('UPDATE users SET is_admin = ? WHERE id = ?', (int(is_admin), user_id))
+        return c.execute(f'SELECT COUNT(*) FROM {table} WHERE {where}', params).fetchone()[0]
 
-def delete_user(user_id):
+def fetch_page(sql, params, limit, offset):
     with get_cursor() as c:
-        c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-        row = c.fetchone()
-        if row:
-            c.execute('DELETE FROM api_keys WHERE username = ?', (row[0],))
-        c.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        return c.execute(f'{sql} LIMIT ? OFFSET ?', (*params, limit, offset)).fetchall()
+
+def like_pattern(text):
+    """Substring LIKE pattern with wildcards in the input escaped."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def page_controls(key, total):
+    """Render page size/number pickers and return (limit, offset)."""
+    col1, col2, col3 = st.columns([1, 1, 2])
+    limit = col1.selectbox("Page size", PAGE_SIZES, key=f"{key}_size")
+    pages = max(1, -(-total // limit))
+    page = col2.number_input("Page", min_value=1, max_value=pages, value=1, key=f"{key}_page")
+    col3.caption(f"{total:,} rows · page {page} of {pages}")
+    return limit, (page - 1) * limit
+
+def filter_clause(column, text):
+    """WHERE clause and params for an optional substring filter."""
+    if not text:
+        return "1", ()
+    return f"{column} LIKE ? ESCAPE '\\'", (like_pattern(text),)
 
 def setup_admin(admin_user, admin_pass, key):
     with get_cursor() as c:
@@ -39,6 +78,55 @@ def setup_admin(admin_user, admin_pass, key):
                 key,
                 "deepseek-reasoner"))
 
+@st.cache_data(ttl=60, show_spinner=False)
+def load_usage_rollup(table, since):
+    """Read usage aggregates newer than `since` from a rollup table."""
+    df = pd.read_sql_query(f'''
+        SELECT bucket, username, model, requests, prompt_tokens, completion_tokens, cache_hit_tokens
+        FROM {table}
+        WHERE bucket >= ?
+        ORDER BY bucket
+    ''', get_connection(), params=(since,))
+    df["total_tokens"] = df["prompt_tokens"] + df["completion_tokens"]
+    return df
+
+def usage_analytics():
+    st.subheader("Usage Analytics")
+    st.caption("Aggregated from hourly/daily rollups (UTC), refreshed about once a minute.")
+    days = st.selectbox("Period", [7, 30, 90, 365], format_func=lambda d: f"Last {d} days")
+    now = pd.Timestamp.now(tz="UTC")
+    daily = load_usage_rollup("usage_daily", (now - pd.Timedelta(days=days)).strftime("%Y-%m-%d"))
+    if daily.empty:
+        st.info("No usage recorded for this period yet.")
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Requests", f"{daily['requests'].sum():,}")
+    col2.metric("Prompt tokens", f"{daily['prompt_tokens'].sum():,}")
+    col3.metric("Completion tokens", f"{daily['completion_tokens'].sum():,}")
+    prompt_total = daily["prompt_tokens"].sum()
+    col4.metric("Prompt cache hit rate",
+                f"{daily['cache_hit_tokens'].sum() / prompt_total:.1%}" if prompt_total else "–")
+
+    st.markdown("**Daily tokens by user**")
+    st.bar_chart(daily.pivot_table(index="bucket", columns="username",
+                                   values="total_tokens", aggfunc="sum", fill_value=0))
+
+    st.markdown("**Daily tokens by model**")
+    st.line_chart(daily.pivot_table(index="bucket", columns="model",
+                                    values="total_tokens", aggfunc="sum", fill_value=0))
+
+    st.markdown("**Hourly requests (last 48 hours)**")
+    hourly = load_usage_rollup("usage_hourly", (now - pd.Timedelta(hours=48)).strftime("%Y-%m-%d %H:00"))
+    st.area_chart(hourly.groupby("bucket")["requests"].sum())
+
+    st.markdown("**Top users**")
+    st.dataframe(
+        daily.groupby("username")[["requests", "prompt_tokens", "cache_hit_tokens", "completion_tokens", "total_tokens"]]
+        .sum().sort_values("total_tokens", ascending=False),
+        use_container_width=True
+    )
+
 def admin_panel():
     if not st.session_state.get('logged_in'):
         login_form()
@@ -59,62 +147,137 @@ def admin_panel():
         return
 
     st.header("DeepGaza Admin Panel")  # Changed header
-    tab1, tab2, tab3, tab4 = st.tabs(["API Key Info", "API Configurations", "Users", "Blacklist"])
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["API Key Info", "API Configurations", "Users", "Blacklist", "Limits & Retention", "Analytics"])
 
     with tab1:
         st.subheader("API Key(s)")
         st.info("API Key is set by the system administrator in the environment file (.env) only. Users cannot create or modify API keys from the interface.")
-        with get_cursor() as c:
-            keys = c.execute('SELECT id, key, username, used_tokens, total_tokens FROM api_keys WHERE is_active = 1').fetchall()
-            for key in keys:
-                with st.expander(f"Key {key[1]}"):
-                    st.write(f"Key: {key[1]}")
-                    st.write(f"User: {key[2]}")
-                    st.write(f"Used tokens: {key[3]}")
-                    st.write(f"Total tokens: {key[4]}")
+        search = st.text_input("Filter by user", key="keys_filter").strip()
+        where, params = filter_clause("username", search)
+        where = f"is_active = 1 AND {where}"
+        limit, offset = page_controls("keys", count_rows("api_keys", where, params))
+        keys = fetch_page(f'''
+            SELECT id, key, username, used_tokens, total_tokens
+            FROM api_keys WHERE {where} ORDER BY id
+        ''', params, limit, offset)
+        st.dataframe(pd.DataFrame(keys, columns=["ID", "Key", "User", "Used tokens", "Total tokens"]),
+                     hide_index=True, use_container_width=True)
 
     with tab2:
         st.subheader("API Configuration Management")
         st.info("API configuration is managed by the system. To change the API key, edit the .env file and restart the application.")
-        with get_cursor() as c:
-            configs = c.execute('SELECT id, config_name, base_url, model_name, is_active FROM api_configurations').fetchall()
-            for config in configs:
-                with st.expander(f"{config[1]} ({'Active' if config[4] else 'Inactive'})"):
-                    st.code(f"Base URL: {config[2]}\nModel: {config[3]}")
+        limit, offset = page_controls("configs", count_rows("api_configurations"))
+        configs = fetch_page('''
+            SELECT id, config_name, base_url, model_name, is_active
+            FROM api_configurations ORDER BY id
+        ''', (), limit, offset)
+        for config in configs:
+            with st.expander(f"{config[1]} ({'Active' if config[4] else 'Inactive'})"):
+                st.code(f"Base URL: {config[2]}\nModel: {config[3]}")
 
     with tab3:
         st.subheader("User Management")
-        register_form()
-        with get_cursor() as c:
-            users = c.execute('SELECT id, username, is_admin FROM users').fetchall()
-        for user in users:
-            cols = st.columns([3,1,1])
-            cols[0].write(user[1])
-            is_admin = cols[1].checkbox("Admin", value=bool(user[2]), key=f"admin_{user[1]}")
-            if is_admin != user[2]:
-                update_admin_status(user[0], is_admin)
-            if cols[2].button("Delete", key=f"del_{user[1]}"):
-                delete_user(user[0])
-                st.rerun()
+        if register_form():
+            count_rows.clear()
+        col1, col2 = st.columns([2, 1])
+        search = col1.text_input("Filter by username", key="users_filter").strip()
+        sort = col2.selectbox("Sort", list(USER_SORTS), key="users_sort")
+        where, params = filter_clause("username", search)
+        limit, offset = page_controls("users", count_rows("users", where, params))
+        users = pd.DataFrame(fetch_page(f'''
+            SELECT id, username, is_admin, created_at
+            FROM users WHERE {where} ORDER BY {USER_SORTS[sort]}
+        ''', params, limit, offset), columns=["id", "username", "is_admin", "created_at"])
+        users["is_admin"] = users["is_admin"].astype(bool)
+        users["delete"] = False
+
+        # Edits are collected across the page and applied together
+        edited = st.data_editor(
+            users,
+            key=f"users_editor_{search}_{sort}_{limit}_{offset}",
+            hide_index=True,
+            use_container_width=True,
+            disabled=["id", "username", "created_at"],
+            column_config={
+                "id": None,
+                "username": "Username",
+                "created_at": "Created",
+                "is_admin": st.column_config.CheckboxColumn("Admin"),
+                "delete": st.column_config.CheckboxColumn("Delete"),
+            },
+        )
+        admin_updates = [
+            (int(row.id), bool(row.is_admin))
+            for row, before in zip(edited.itertuples(), users.itertuples())
+            if row.is_admin != before.is_admin and not row.delete
+        ]
+        deleted_ids = [int(row.id) for row in edited.itertuples() if row.delete]
+        if st.button("Apply changes", disabled=not (admin_updates or deleted_ids)):
+            apply_user_changes(admin_updates, deleted_ids)
+            st.rerun()
 
     with tab4:
         st.subheader("Blacklist Management")
-        with get_cursor() as c:
-            with st.form("Blacklist Actions"):
-                username = st.text_input("Username")
-                reason = st.text_input("Reason")
-                col1, col2 = st.columns(2)
-                if col1.form_submit_button("Add"):
-                    try:
+        with st.form("Blacklist Actions"):
+            username = st.text_input("Username")
+            reason = st.text_input("Reason")
+            col1, col2 = st.columns(2)
+            if col1.form_submit_button("Add"):
+                try:
+                    with get_cursor() as c:
                         c.execute('INSERT INTO blacklist (username, reason) VALUES (?, ?)', (username, reason))
-                        st.success("Added to blacklist")
-                    except sqlite3.IntegrityError:
-                        st.error("User already in blacklist")
-                if col2.form_submit_button("Remove"):
+                    count_rows.clear()
+                    st.success("Added to blacklist")
+                except sqlite3.IntegrityError:
+                    st.error("User already in blacklist")
+            if col2.form_submit_button("Remove"):
+                with get_cursor() as c:
                     c.execute('DELETE FROM blacklist WHERE username = ?', (username,))
-                    st.success("Removed from blacklist")
+                count_rows.clear()
+                st.success("Removed from blacklist")
+
+        st.subheader("Blacklist Entries")
+        search = st.text_input("Filter by username", key="blacklist_filter").strip()
+        where, params = filter_clause("username", search)
+        limit, offset = page_controls("blacklist", count_rows("blacklist", where, params))
+        blacklist = fetch_page(f'''
+            SELECT username, reason, created_at
+            FROM blacklist WHERE {where} ORDER BY username
+        ''', params, limit, offset)
+        st.dataframe(pd.DataFrame(blacklist, columns=["Username", "Reason", "Added"]),
+                     hide_index=True, use_container_width=True)
+
+    with tab5:
+        st.subheader("Rate Limits & Quota")
+        st.info("Limits apply per user and per API key across all sessions. Set requests per minute to 0 to disable a limit.")
+        limits = get_limits()
+        with st.form("Rate Limits"):
+            col1, col2 = st.columns(2)
+            user_rpm = col1.number_input("User requests / minute", min_value=0, value=limits["user_requests_per_minute"])
+            user_burst = col2.number_input("User burst", min_value=1, value=max(limits["user_burst"], 1))
+            key_rpm = col1.number_input("Key requests / minute", min_value=0, value=limits["key_requests_per_minute"])
+            key_burst = col2.number_input("Key burst", min_value=1, value=max(limits["key_burst"], 1))
+            reserve = st.number_input("Output tokens reserved per request", min_value=0,
+                                      value=limits["output_reserve_tokens"],
+                                      help="Reserved from the quota up front and reconciled with actual usage when the response finishes")
+            if st.form_submit_button("Save"):
+                update_limits({
+                    "user_requests_per_minute": user_rpm,
+                    "user_burst": user_burst,
+                    "key_requests_per_minute": key_rpm,
+                    "key_burst": key_burst,
+                    "output_reserve_tokens": reserve,
+                })
+                st.success("Limits updated")
+
+        st.subheader("Chat History Retention")
+        with st.form("History Retention"):
+            retention = st.number_input("Conversations kept per user", min_value=0,
+                                        value=get_history_retention(),
+                                        help="Older conversations are deleted when a session is saved. 0 keeps everything.")
+            if st.form_submit_button("Save"):
+                set_settings({"history_retention": retention})
+                st.success("Retention updated")
 
-            st.subheader("Blacklist Entries")
-            blacklist = c.execute('SELECT username, reason FROM blacklist').fetchall()
-            for entry in blacklist:
-                st.write(f"{entry[0]} - {entry[1]}")
\ No newline at end of file
+    with tab6:
+        usage_analytics()
\ No newline at end of file
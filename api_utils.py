@@ -3,6 +3,7 @@ import requests
 from openai import OpenAI
 import streamlit as st
 from db_utils import conn, get_cursor
+from quota_utils import estimate_tokens, settle_reservation, release_reservation
 
 def web_search(query, api_key):
     """Perform Google search and return formatted results."""
@@ -45,46 +46,62 @@ def get_active_api_config():
         result = c.fetchone()
     return result or ("https://api.deepseek.com/v1", "", "deepseek-reasoner")
 
-def process_stream(stream, used_key):
-    """Process both reasoning and response phases, returning reasoning_content separately."""
+def parse_chunk(chunk):
+    """Split a streamed completion chunk into (reasoning, content, usage)."""
+    usage = getattr(chunk, "usage", None)
+    if not chunk.choices:
+        return "", "", usage
+    delta = chunk.choices[0].delta
+    reasoning = getattr(delta, "reasoning_content", "") or ""
+    content = getattr(delta, "content", "") or ""
+    return reasoning, content, usage
+
+def process_stream(stream, used_key, reservation=None):
+    """Process both reasoning and response phases, returning reasoning_content separately.
+
+    Tokens are counted locally and charged once at the end, settling the
+    quota reservation if one was made (or releasing it if the stream produced
+    nothing). When the request asked for
+    stream_options={"include_usage": True}, the final usage chunk is used instead.
+    """
     thinking_content = ""
     response_content = ""
     
     response_placeholder = st.empty()
     total_count = 0
-    chunk_num = 0
+    usage = None
+    received = False
     
-    with st.status("Thinking...", expanded=True) as status:
-        thinking_placeholder = st.empty()
-        thinking_phase = True
-        
-        for chunk in stream:
-            chunk_num += 1
-            reasoning = getattr(chunk.choices[0].delta, "reasoning_content", "") or ""
-            content = getattr(chunk.choices[0].delta, "content", "") or ""
-            if thinking_phase:
-                thinking_content += reasoning
-                thinking_placeholder.markdown(thinking_content)
-                if content:
-                    status.update(label="Reasoning complete", state="complete", expanded=False)
-                    thinking_phase = False
-                    response_placeholder.markdown("▌")
-            response_content += content
-            if not thinking_phase:
-                response_placeholder.markdown(response_content + "▌")
-            adjusted_length = sum(2 if '\u4e00' <= c <= '\u9fff' else 1 for c in (reasoning + content))
-            total_count += adjusted_length
-            if chunk_num % 10 == 0:
-                with get_cursor() as c: 
-                    c.execute(
-                        "UPDATE api_keys SET used_tokens = used_tokens + ? WHERE key = ?",
-                        (total_count, used_key)
-                    )
-                    total_count = 0
-        response_placeholder.markdown(response_content)
-        with get_cursor() as c: 
-            c.execute(
-                "UPDATE api_keys SET used_tokens = used_tokens + ? WHERE key = ?",
-                (total_count, used_key)
-            )
-    return thinking_content, response_content
\ No newline at end of file
+    try:
+        with st.status("Thinking...", expanded=True) as status:
+            thinking_placeholder = st.empty()
+            thinking_phase = True
+            
+            for chunk in stream:
+                received = True
+                reasoning, content, chunk_usage = parse_chunk(chunk)
+                usage = chunk_usage or usage
+                if thinking_phase:
+                    thinking_content += reasoning
+                    thinking_placeholder.markdown(thinking_content)
+                    if content:
+                        status.update(label="Reasoning complete", state="complete", expanded=False)
+                        thinking_phase = False
+                        response_placeholder.markdown("▌")
+                response_content += content
+                if not thinking_phase:
+                    response_placeholder.markdown(response_content + "▌")
+                total_count += estimate_tokens(reasoning + content)
+            response_placeholder.markdown(response_content)
+    finally:
+        if reservation is not None and not received:
+            release_reservation(reservation)
+        elif reservation is not None:
+            settle_reservation(reservation, total_count, usage)
+        elif total_count:
+            with get_cursor() as c: 
+                c.execute(
+                    "UPDATE api_keys SET used_tokens = used_tokens + ? WHERE key = ?",
+                    (total_count, used_key)
+                )
+    return thinking_content, response_content
@@ -8,9 +8,16 @@ from openai import OpenAI
 from db_utils import conn, get_cursor
 from auth_utils import login_form, register_form, hash_password
 from admin_utils import admin_panel, setup_admin
-from file_utils import save_uploaded_files, format_file_contents
+from file_utils import save_uploaded_files
+from prompt_utils import build_system_message, build_prompt_messages
 from api_utils import web_search, get_active_api_config, process_stream
-from helper_utils import save_session, load_session, display_chat_history
+from usage_utils import start_compactor
+from quota_utils import check_rate_limit, reserve_tokens, release_reservation, estimate_tokens
+from helper_utils import (
+    save_session, load_session, display_chat_history, reset_history_window,
+    get_history_retention
+)
+from search_utils import search_history, start_search_backfill, MIN_TERM_LENGTH
 
 # ====== Hide Streamlit branding, deploy banner, and logo ======
 hide_streamlit_style = """
@@ -31,14 +38,13 @@ hide_streamlit_style = """
 st.markdown(hide_streamlit_style, unsafe_allow_html=True)
 # =============================================================
 
-# Default system role template
-DEFAULT_SYSTEM_ROLE = (
-    "You are an AI assistant, please answer the questions asked by the user. "
-    "At the same time, if the user provides search results, please add the corresponding references in the answer. "
-    "If you need to output mathematical formulas in LaTeX format, please write mathematical formulas in Obsidian compatible LaTeX format, "
-    "with the following requirements: 1. Inline formulas are wrapped with a single $, such as $x^2$. "
-    "2. Independent formula blocks are wrapped with two $$, such as: $$\\int_a^b f(x)dx$$."
-)
+# Most sessions listed in the sidebar; older ones are reachable through search
+SIDEBAR_HISTORY_LIMIT = 50
+
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_search(username, query):
+    """Search results per (username, query); reruns while typing reuse them."""
+    return search_history(username, query)
 
 def handle_user_input():
     base_url = "https://api.deepseek.com/v1"
@@ -63,6 +69,10 @@ def handle_user_input():
         st.session_state.uploaded_files.extend(new_files)
         st.session_state['file_uploader'].clear()
 
+    if st.session_state.uploaded_files:
+        names = ", ".join(f["name"] for f in st.session_state.uploaded_files)
+        st.caption(f"📎 Files in context: {names}")
+
     user_content = []
     if user_input := st.chat_input("Ask me anything!"):
         user_content.append(user_input)
@@ -74,37 +84,42 @@ def handle_user_input():
             except Exception as e:
                 st.error(f"Search failed: {str(e)}")
 
-        if st.session_state.uploaded_files:
-            file_content = format_file_contents(st.session_state.uploaded_files)
-            user_content.append("\n[Uploaded files content]\n" + file_content)
-            st.session_state.uploaded_files = []
-
         full_content = "\n".join(user_content)
 
-        with get_cursor() as c:
-            key_obj = c.execute('SELECT id, key, used_tokens, total_tokens FROM api_keys WHERE key = ?', 
-                        (api_key,)).fetchone()
-        adjusted_length = sum(2 if '\u4e00' <= c <= '\u9fff' else 1 for c in full_content)
-        if key_obj and key_obj[2] + adjusted_length >= key_obj[3]:
-            st.error("Quota exhausted, please contact the admin.")
+        username = st.session_state.get("username", "admin")
+        if wait := check_rate_limit(username, api_key):
+            st.error(f"Too many requests, please retry in {wait:.0f} seconds.")
             return
 
-        with get_cursor() as c:
-            c.execute('UPDATE api_keys SET used_tokens = used_tokens + ? WHERE key = ?', 
-                 (adjusted_length, api_key))
+        # Uploaded files stay in the system prompt for the whole session so
+        # follow-up turns share a cacheable prefix
+        prompt = build_prompt_messages(
+            st.session_state.messages + [{"role": "user", "content": full_content}],
+            st.session_state.uploaded_files
+        )
+        prompt_tokens = sum(estimate_tokens(m["content"]) for m in prompt)
+        reservation = reserve_tokens(api_key, username, prompt_tokens, model_name)
+        if reservation is None:
+            st.error("Quota exhausted, please contact the admin.")
+            return
 
         st.session_state.messages.append({"role": "user", "content": full_content})
         with st.chat_message("user"):
             st.markdown(user_input)
 
         with st.chat_message("assistant"):
-            stream = client.chat.completions.create(
-                model=model_name,
-                messages=st.session_state.messages,
-                stream=True,
-                max_tokens=32768
-            )
-            reasoning_content, total_content = process_stream(stream, api_key)
+            try:
+                stream = client.chat.completions.create(
+                    model=model_name,
+                    messages=prompt,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    max_tokens=32768
+                )
+            except Exception:
+                release_reservation(reservation)
+                raise
+            reasoning_content, total_content = process_stream(stream, api_key, reservation)
             st.session_state.messages.append(
                 {"role": "assistant", "content": total_content}
             )
@@ -145,34 +160,42 @@ def main_interface():
             username = "admin"
             if st.button("🆕 - New Chat"):
                 st.session_state.current_session_id = str(uuid.uuid4())
-                # Determine which system role to use
-                system_content = st.session_state.custom_system_role.strip()
-                if system_content:
-                    system_message = {
-                        "role": "system",
-                        "content": (
-                            f"{system_content}, please answer the questions asked by the user. "
-                            "At the same time, if the user provides search results, please add the corresponding references in the answer. "
-                            "If you need to output mathematical formulas in LaTeX format, please write mathematical formulas in Obsidian compatible LaTeX format, "
-                            "with the following requirements: 1. Inline formulas are wrapped with a single $, such as $x^2$. "
-                            "2. Independent formula blocks are wrapped with two $$, such as: $$\\int_a^b f(x)dx$$."
-                        )
-                    }
-                else:
-                    system_message = {"role": "system", "content": DEFAULT_SYSTEM_ROLE}
-                st.session_state.messages = [system_message]
+                st.session_state.messages = [
+                    build_system_message(st.session_state.custom_system_role)
+                ]
+                st.session_state.uploaded_files = []
+                reset_history_window()
                 st.session_state.show_admin = False
                 st.rerun()
 
+            search_query = st.text_input(
+                "🔎 Search chats",
+                placeholder="Search past conversations",
+                key="history_search"
+            ).strip()
+            if search_query:
+                results = cached_search(username, search_query)
+                if not results:
+                    st.caption(f"No matches (terms need at least {MIN_TERM_LENGTH} characters)")
+                for session_id, session_name, snippet in results:
+                    if st.button(f"🗨️ {session_name}", key=f"found_{session_id}"):
+                        st.session_state.show_admin = False
+                        load_session(session_id)
+                    st.caption(snippet)
+
             st.subheader("Chat History")
+            retention = get_history_retention()
+            sidebar_limit = min(retention, SIDEBAR_HISTORY_LIMIT) if retention else SIDEBAR_HISTORY_LIMIT
             with get_cursor() as c:
                 histories = c.execute('''
                     SELECT session_id, session_name, updated_at 
                     FROM history 
                     WHERE username = ? 
                     ORDER BY updated_at DESC 
-                    LIMIT 10
-                ''', (username,)).fetchall()
+                    LIMIT ?
+                ''', (username, sidebar_limit)).fetchall()
+            if len(histories) == sidebar_limit:
+                st.caption(f"Showing the {sidebar_limit} most recent chats, use search to find older ones")
 
             for hist in histories:
                 session_id = hist[0]
@@ -242,27 +265,17 @@ def main_interface():
 
 def main():
     setup_admin(admin_user, hash_password(admin_pass), api_key)
+    start_compactor()
+    start_search_backfill()
 
     if 'current_session_id' not in st.session_state:
         st.session_state.current_session_id = str(uuid.uuid4())
 
     if "messages" not in st.session_state:
         # Determine which system role to use at startup
-        system_content = st.session_state.get("custom_system_role", "").strip()
-        if system_content:
-            system_message = {
-                "role": "system",
-                "content": (
-                    f"{system_content}, please answer the questions asked by the user. "
-                    "At the same time, if the user provides search results, please add the corresponding references in the answer. "
-                    "If you need to output mathematical formulas in LaTeX format, please write mathematical formulas in Obsidian compatible LaTeX format, "
-                    "with the following requirements: 1. Inline formulas are wrapped with a single $, such as $x^2$. "
-                    "2. Independent formula blocks are wrapped with two $$, such as: $$\\int_a^b f(x)dx$$."
-                )
-            }
-        else:
-            system_message = {"role": "system", "content": DEFAULT_SYSTEM_ROLE}
-        st.session_state.messages = [system_message]
+        st.session_state.messages = [
+            build_system_message(st.session_state.get("custom_system_role", ""))
+        ]
         st.session_state.valid_key = False
 
     if not st.session_state.get('valid_key'):
@@ -274,16 +287,7 @@ def main():
             st.session_state.used_key = os.getenv("DEEPSEEK_API_KEY")
             st.session_state.username = "admin"
             # Replace system message with the customized one
-            st.session_state.messages = [{
-                "role": "system",
-                "content": (
-                    f"{user_key.strip()}, please answer the questions asked by the user. "
-                    "At the same time, if the user provides search results, please add the corresponding references in the answer. "
-                    "If you need to output mathematical formulas in LaTeX format, please write mathematical formulas in Obsidian compatible LaTeX format, "
-                    "with the following requirements: 1. Inline formulas are wrapped with a single $, such as $x^2$. "
-                    "2. Independent formula blocks are wrapped with two $$, such as: $$\\int_a^b f(x)dx$$."
-                )
-            }]
+            st.session_state.messages = [build_system_message(user_key)]
             st.rerun()
         else:
             # If left blank, use the default
@@ -291,10 +295,7 @@ def main():
             st.session_state.valid_key = True
             st.session_state.used_key = os.getenv("DEEPSEEK_API_KEY")
             st.session_state.username = "admin"
-            st.session_state.messages = [{
-                "role": "system",
-                "content": DEFAULT_SYSTEM_ROLE
-            }]
+            st.session_state.messages = [build_system_message()]
             st.rerun()
 
     main_interface()
@@ -15,14 +15,21 @@ def is_blacklisted(username):
         c.execute('SELECT 1 FROM blacklist WHERE username = ?', (username,))
         return c.fetchone() is not None
 
-def authenticate_user(username, password):
+def check_credentials(username, password):
+    """Return the user's admin flag if the password matches, else None."""
     with get_cursor() as c: 
         c.execute('SELECT password_hash, is_admin FROM users WHERE username = ?', (username,))
         result = c.fetchone()
     if result and verify_password(password, result[0]):
-        st.session_state.is_admin = bool(result[1])
-        return True
-    return False
+        return bool(result[1])
+    return None
+
+def authenticate_user(username, password):
+    is_admin = check_credentials(username, password)
+    if is_admin is None:
+        return False
+    st.session_state.is_admin = is_admin
+    return True
 
 def login_form():
     with st.form("Login"):
@@ -40,6 +47,7 @@ def login_form():
                 st.error("Invalid credentials")
 
 def register_form():
+    """Render the registration form; return True when a user was created."""
     with st.form("Register"):
         username = st.text_input("New username")
         password = st.text_input("New password", type="password")
@@ -52,5 +60,7 @@ def register_form():
                     c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)',
                          (username, hash_password(password)))
                 st.success("Registration successful! Please log in.")
+                return True
             except sqlite3.IntegrityError:
-                st.error("Username already exists")
\ No newline at end of file
+                st.error("Username already exists")
+    return False
\ No newline at end of file
@@ -1,3 +1,4 @@
+import json
 import sqlite3
 import threading
 from contextlib import contextmanager
@@ -14,7 +15,9 @@ local = threading.local()
 
 def get_connection():
     if not hasattr(local, 'conn'):
-        local.conn = sqlite3.connect('app.db', check_same_thread=False)
+        local.conn = sqlite3.connect('app.db', check_same_thread=False, timeout=30)
+        # WAL lets concurrent sessions read while another one writes
+        local.conn.execute('PRAGMA journal_mode=WAL')
     return local.conn
 
 @contextmanager
@@ -31,6 +34,12 @@ def get_cursor():
     finally:
         cursor.close()
 
+def add_column(c, table, column, definition):
+    """Add a column to an existing table if an older schema lacks it."""
+    columns = [row[1] for row in c.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
 def initialize_database():
     with get_cursor() as c:
         c.execute('''
@@ -84,6 +93,90 @@ def initialize_database():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )''')
 
+        # Indexes behind the paginated admin tables
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_api_keys_username ON api_keys(username)')
+
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS app_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+        # Append-only usage ledger, compacted into hourly/daily rollups by usage_utils
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS usage_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER NOT NULL,
+            username TEXT,
+            key_id INTEGER,
+            model TEXT,
+            prompt_tokens INTEGER DEFAULT 0,
+            completion_tokens INTEGER DEFAULT 0,
+            cache_hit_tokens INTEGER DEFAULT 0
+        )''')
+        add_column(c, 'usage_events', 'cache_hit_tokens', 'INTEGER DEFAULT 0')
+        # Older ledgers stored the raw API key; keep only a reference to api_keys.id
+        if 'api_key' in [row[1] for row in c.execute('PRAGMA table_info(usage_events)')]:
+            add_column(c, 'usage_events', 'key_id', 'INTEGER')
+            c.execute('''
+                UPDATE usage_events
+                SET key_id = (SELECT id FROM api_keys WHERE api_keys.key = usage_events.api_key)
+            ''')
+            c.execute('ALTER TABLE usage_events DROP COLUMN api_key')
+
+        for table in ('usage_hourly', 'usage_daily'):
+            c.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT NOT NULL,
+                username TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requests INTEGER DEFAULT 0,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                cache_hit_tokens INTEGER DEFAULT 0,
+                PRIMARY KEY (bucket, username, model)
+            )''')
+            add_column(c, table, 'cache_hit_tokens', 'INTEGER DEFAULT 0')
+
+        # Per-message copy of history for full-text search; history_fts indexes it
+        # through triggers so saves only touch the new messages
+        add_column(c, 'history', 'indexed_count', 'INTEGER DEFAULT 0')
+        add_column(c, 'history', 'indexed_hash', 'TEXT')
+
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS history_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            msg_index INTEGER NOT NULL,
+            role TEXT,
+            content TEXT
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_history_messages_session ON history_messages(session_id)')
+
+        c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+            content,
+            content='history_messages',
+            content_rowid='id',
+            tokenize='trigram'
+        )''')
+
+        c.execute('''
+        CREATE TRIGGER IF NOT EXISTS history_messages_ai AFTER INSERT ON history_messages BEGIN
+            INSERT INTO history_fts(rowid, content) VALUES (new.id, new.content);
+        END''')
+        c.execute('''
+        CREATE TRIGGER IF NOT EXISTS history_messages_ad AFTER DELETE ON history_messages BEGIN
+            INSERT INTO history_fts(history_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END''')
+        c.execute('''
+        CREATE TRIGGER IF NOT EXISTS history_ad AFTER DELETE ON history BEGIN
+            DELETE FROM history_messages WHERE session_id = old.session_id;
+        END''')
+
     # Insert .env API key into api_keys table if not exists for default admin
     if API_KEY:
         with get_cursor() as c:
@@ -94,4 +187,30 @@ def initialize_database():
                     VALUES (?, ?, ?, 1)
                 ''', (API_KEY, 'admin', 1000000))  # Example: 1M tokens quota
 
+def pack_session_data(messages, documents):
+    """Serialize a session for the history.session_data column."""
+    return json.dumps({"messages": messages, "documents": documents})
+
+def unpack_session_data(session_data):
+    """Return (messages, documents); older rows stored only the message list."""
+    data = json.loads(session_data)
+    if isinstance(data, list):
+        return data, []
+    return data["messages"], data.get("documents", [])
+
+def get_settings():
+    """Return all admin-configurable settings as a dict of strings."""
+    with get_cursor() as c:
+        return dict(c.execute('SELECT name, value FROM app_settings').fetchall())
+
+def set_settings(values):
+    """Upsert several settings in one transaction."""
+    with get_cursor() as c:
+        c.executemany('''
+            INSERT INTO app_settings (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                value = excluded.value,
+                updated_at = CURRENT_TIMESTAMP
+        ''', [(name, str(value)) for name, value in values.items()])
+
 initialize_database()
\ No newline at end of file
@@ -1,9 +1,40 @@
 # file_utils.py
 import hashlib
 import os
+import tempfile
 import textract
 import streamlit as st
 
+MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB limit
+TEXTRACT_EXTENSIONS = ('.doc', '.docx', '.pdf', '.jpg', '.png')
+
+def parse_file(upload_dir, name, data):
+    """Parse raw file bytes via a private temp file in upload_dir and return file info."""
+    # Each upload gets its own path so concurrent uploads of the same
+    # filename never read each other's bytes; textract picks the parser by suffix
+    suffix = os.path.splitext(name)[1].lower()
+    with tempfile.NamedTemporaryFile(dir=upload_dir, suffix=suffix, delete=False) as f:
+        f.write(data)
+        file_path = f.name
+
+    try:
+        # Parse file content
+        if suffix in TEXTRACT_EXTENSIONS:
+            content = textract.process(file_path).decode("utf-8")
+        else:
+            with open(file_path, "r", encoding="utf-8") as f:
+                content = f.read()
+    finally:
+        os.remove(file_path)
+
+    return {
+        "name": name,
+        "content": content,
+        "size": len(data),
+        # Generate content hash
+        "hash": hashlib.md5(content.encode()).hexdigest()
+    }
+
 def save_uploaded_files(upload_dir, uploaded_files):
     """Save uploaded files to a temporary directory and return file info."""
     saved_files = []
@@ -13,36 +44,18 @@ def save_uploaded_files(upload_dir, uploaded_files):
         if file.name in current_files:
             continue
 
-        if file.size > 10 * 1024 * 1024:  # 10MB limit
+        if file.size > MAX_FILE_SIZE:
             st.error(f"File {file.name} exceeds size limit.")
             continue
 
         try:
-            # Save file to specified directory
-            file_path = os.path.join(upload_dir, file.name)
-            with open(file_path, "wb") as f:
-                f.write(file.getbuffer())
-
-            # Parse file content
-            if file.name.endswith(('.doc', '.docx', '.pdf', '.jpg', '.png')):
-                content = textract.process(file_path).decode("utf-8")
-            else:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-
-            # Generate content hash
-            content_hash = hashlib.md5(content.encode()).hexdigest()
+            info = parse_file(upload_dir, file.name, file.getbuffer())
 
             # Check for duplicate content
-            if any(f["hash"] == content_hash for f in st.session_state.uploaded_files):
+            if any(f["hash"] == info["hash"] for f in st.session_state.uploaded_files):
                 continue
 
-            saved_files.append({
-                "name": file.name,
-                "content": content,
-                "size": file.size,
-                "hash": content_hash
-            })
+            saved_files.append(info)
 
         except Exception as e:
             st.error(f"Failed to parse file {file.name}: {str(e)}")
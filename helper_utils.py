@@ -3,89 +3,159 @@ import json
 import uuid
 from datetime import datetime
 import streamlit as st
-from db_utils import conn, get_cursor
+from db_utils import conn, get_cursor, get_settings, pack_session_data, unpack_session_data
+from search_utils import index_session_messages
+
+# 每个用户默认保留的会话数量，0 表示不限制
+DEFAULT_HISTORY_RETENTION = 10
+
+def get_history_retention():
+    """读取管理员配置的会话保留数量"""
+    return int(get_settings().get("history_retention", DEFAULT_HISTORY_RETENTION))
+
+def store_session(username, session_id, messages, documents):
+    """保存会话并增量更新索引，同时清理超出保留数量的旧会话"""
+    retention = get_history_retention()
+    with get_cursor() as c: 
+        c.execute("""
+            INSERT INTO history (
+                username, 
+                session_id, 
+                session_name, 
+                session_data
+            ) VALUES (?, ?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                session_data = excluded.session_data,
+                updated_at = CURRENT_TIMESTAMP
+        """, (
+            username,
+            session_id,
+            f"会话-{datetime.now().strftime('%m-%d %H:%M')}",
+            pack_session_data(messages, documents)
+        ))
+
+        # 增量更新全文索引
+        index_session_messages(c, username, session_id, messages)
+
+        # 清理超出保留数量的旧记录（索引由触发器同步删除）
+        if retention:
+            c.execute("""
+                DELETE FROM history 
+                WHERE username = ?
+                AND id NOT IN (
+                    SELECT id 
+                    FROM history 
+                    WHERE username = ?
+                    ORDER BY updated_at DESC 
+                    LIMIT ?
+                )
+            """, (username, username, retention))
+
+def fetch_session(session_id):
+    """读取会话，返回 (username, messages, documents)，不存在时返回 None"""
+    with get_cursor() as c: 
+        row = c.execute("""
+            SELECT username, session_data 
+            FROM history 
+            WHERE session_id = ?
+        """, (session_id,)).fetchone()
+    if row is None:
+        return None
+    return (row[0], *unpack_session_data(row[1]))
 
 def save_session():
     """保存当前会话到数据库"""
     if st.session_state.get("valid_key") and "current_session_id" in st.session_state:
         try:
-            session_data = json.dumps(st.session_state.messages)
             with get_cursor() as c: 
                 username = c.execute(
                     "SELECT username FROM api_keys WHERE key = ?",
                     (st.session_state.used_key,)
                 ).fetchone()[0]
-                
-                c.execute("""
-                    INSERT INTO history (
-                        username, 
-                        session_id, 
-                        session_name, 
-                        session_data
-                    ) VALUES (?, ?, ?, ?)
-                    ON CONFLICT(session_id) DO UPDATE SET
-                        session_data = excluded.session_data,
-                        updated_at = CURRENT_TIMESTAMP
-                """, (
-                    username,
-                    st.session_state.current_session_id,
-                    f"会话-{datetime.now().strftime('%m-%d %H:%M')}",
-                    session_data
-                ))
-
-                # 清理旧记录
-                c.execute("""
-                    DELETE FROM history 
-                    WHERE username = ?
-                    AND id NOT IN (
-                        SELECT id 
-                        FROM history 
-                        WHERE username = ?
-                        ORDER BY updated_at DESC 
-                        LIMIT 10
-                    )
-                """, (username, username))
-
+            store_session(
+                username,
+                st.session_state.current_session_id,
+                st.session_state.messages,
+                st.session_state.get("uploaded_files", [])
+            )
         except Exception as e:
             st.error(f"保存会话失败: {str(e)}")
 
 def load_session(session_id):
     """从数据库加载指定会话"""
     try:
-        with get_cursor() as c: 
-            c.execute("""
-                SELECT session_data 
-                FROM history 
-                WHERE session_id = ?
-            """, (session_id,))
-            if data := c.fetchone():
-                st.session_state.messages = json.loads(data[0])
-                st.session_state.current_session_id = session_id
-                st.rerun()
+        if session := fetch_session(session_id):
+            _, st.session_state.messages, st.session_state.uploaded_files = session
+            st.session_state.current_session_id = session_id
+            reset_history_window()
+            st.rerun()
     except Exception as e:
         st.error(f"加载会话失败: {str(e)}")
 
-def display_message(message):
+# 每次重绘只渲染最近的若干条消息，更早的消息通过"加载更早消息"按需展开
+HISTORY_PAGE_SIZE = 20
+# 超过该长度的上传文件内容默认折叠，只在用户展开时渲染
+FILE_PAYLOAD_COLLAPSE_CHARS = 2000
+FILE_PAYLOAD_MARKER = "\n[Uploaded files content]\n"
+
+def _split_assistant_content(content):
+    """拆分助理消息中的思考过程与回答（只对窗口内的消息调用，str.partition 足够快）"""
+    if "<think>" not in content:
+        return "", content
+    reasoning, _, answer = content.partition("</think>")
+    return reasoning.replace("<think>", "", 1).strip("\n"), answer
+
+def _split_user_content(content):
+    """拆分用户消息中的提问与上传文件内容"""
+    question, marker, files = content.partition(FILE_PAYLOAD_MARKER)
+    return question, files if marker else ""
+
+def display_message(message, index):
     """显示聊天消息"""
     role = message["role"]
     with st.chat_message(role):
         if role == "assistant":
-            _display_assistant_message(message["content"])
+            _display_assistant_message(message["content"], index)
         else:
-            st.markdown(message["content"])
+            _display_user_message(message["content"], index)
 
-def _display_assistant_message(content):
+def _display_assistant_message(content, index):
     """解析并显示助理消息"""
-    if "<think>" in content:
-        parts = content.split("</think>")
-        with st.expander("查看思考过程"):
-            st.markdown(f"```\n{parts[0][7:]}\n```")
-        st.markdown(parts[1])
-    else:
+    reasoning, answer = _split_assistant_content(content)
+    if reasoning and _lazy_toggle("查看思考过程", f"think_{index}"):
+        st.markdown(f"```\n{reasoning}\n```")
+    st.markdown(answer)
+
+def _display_user_message(content, index):
+    """显示用户消息，较大的文件内容折叠后按需加载"""
+    question, files = _split_user_content(content)
+    if len(files) <= FILE_PAYLOAD_COLLAPSE_CHARS:
         st.markdown(content)
+        return
+    st.markdown(question)
+    if _lazy_toggle(f"📎 上传文件内容 ({len(files)} 字符)", f"files_{index}"):
+        st.markdown(files)
+
+def _lazy_toggle(label, key):
+    """仅在展开时才渲染内容，避免每次重绘都向浏览器发送大段文本"""
+    return st.toggle(label, key=f"{st.session_state.get('current_session_id')}_{key}")
+
+def reset_history_window():
+    """切换会话后只显示最近一页消息"""
+    st.session_state.history_window = HISTORY_PAGE_SIZE
 
 def display_chat_history():
-    """显示完整的聊天记录"""
-    for message in st.session_state.messages:
-        if message["role"] != "system":
-            display_message(message)
+    """按窗口显示聊天记录，只渲染最近的消息"""
+    messages = st.session_state.messages
+    visible = [i for i, m in enumerate(messages) if m["role"] != "system"]
+    window = st.session_state.setdefault("history_window", HISTORY_PAGE_SIZE)
+
+    hidden = len(visible) - window
+    if hidden > 0:
+        if st.button(f"⬆️ 加载更早消息 (还有 {hidden} 条)", key="load_earlier"):
+            st.session_state.history_window = window + HISTORY_PAGE_SIZE
+            st.rerun()
+        visible = visible[hidden:]
+
+    for index in visible:
+        display_message(messages[index], index)
@@ -0,0 +1,34 @@
+# prompt_utils.py
+from file_utils import format_file_contents
+
+# Shared instructions always come first so every session starts with the same
+# bytes and the provider can reuse its cached prefix
+SYSTEM_INSTRUCTIONS = (
+    "Please answer the questions asked by the user. "
+    "At the same time, if the user provides search results, please add the corresponding references in the answer. "
+    "If you need to output mathematical formulas in LaTeX format, please write mathematical formulas in Obsidian compatible LaTeX format, "
+    "with the following requirements: 1. Inline formulas are wrapped with a single $, such as $x^2$. "
+    "2. Independent formula blocks are wrapped with two $$, such as: $$\\int_a^b f(x)dx$$."
+)
+DEFAULT_ROLE = "You are an AI assistant."
+DOCUMENTS_HEADER = "\n\n[Uploaded files content]\n"
+
+def build_system_message(custom_role=""):
+    """Canonical system message: fixed instructions, then the (optional) custom role."""
+    role = custom_role.strip() or DEFAULT_ROLE
+    return {"role": "system", "content": f"{SYSTEM_INSTRUCTIONS}\n\nRole: {role}"}
+
+def build_prompt_messages(messages, documents):
+    """Assemble the request as system prompt, then documents, then conversation.
+
+    Documents are kept in upload order and rendered identically every turn, so
+    the prompt only ever grows at the end while they are unchanged.
+    """
+    system = next((m["content"] for m in messages if m["role"] == "system"),
+                  build_system_message()["content"])
+    if documents:
+        system += DOCUMENTS_HEADER + format_file_contents(documents)
+    return [{"role": "system", "content": system}] + [
+        {"role": m["role"], "content": m["content"]}
+        for m in messages if m["role"] != "system"
+    ]
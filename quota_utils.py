@@ -0,0 +1,170 @@
+# quota_utils.py
+import threading
+import time
+from collections import namedtuple
+from db_utils import get_cursor, get_settings, set_settings
+from usage_utils import record_usage
+
+# Default limits, overridable from the admin panel (0 disables a limit).
+# Buckets live in each process, so the Streamlit app and server.py each allow
+# the configured rate; settings are re-read every LIMITS_TTL seconds.
+DEFAULT_LIMITS = {
+    "user_requests_per_minute": 20,
+    "user_burst": 5,
+    "key_requests_per_minute": 120,
+    "key_burst": 20,
+    "output_reserve_tokens": 4096,
+}
+
+# key_id is api_keys.id, so the ledger never stores the secret itself
+Reservation = namedtuple("Reservation", ["key", "key_id", "username", "model", "prompt_tokens", "reserved"])
+
+LIMITS_TTL = 30
+
+_limits = None
+_limits_loaded_at = 0
+_limits_lock = threading.Lock()
+
+def estimate_tokens(text):
+    """Rough token count: CJK characters count double."""
+    return sum(2 if '\u4e00' <= ch <= '\u9fff' else 1 for ch in text)
+
+def get_limits():
+    """Return the cached limits, reloading them from app_settings once they are stale."""
+    global _limits, _limits_loaded_at
+    if _limits is None or time.monotonic() - _limits_loaded_at > LIMITS_TTL:
+        with _limits_lock:
+            if _limits is None or time.monotonic() - _limits_loaded_at > LIMITS_TTL:
+                stored = get_settings()
+                limits = {name: int(stored.get(name, default))
+                          for name, default in DEFAULT_LIMITS.items()}
+                if _limits is not None and limits != _limits:
+                    # Another process saved new limits; rebuild buckets with them
+                    _limiter.reset()
+                _limits, _limits_loaded_at = limits, time.monotonic()
+    return _limits
+
+def update_limits(values):
+    """Persist new limits and apply them to this process immediately."""
+    global _limits, _limits_loaded_at
+    values = {name: int(values[name]) for name in DEFAULT_LIMITS if name in values}
+    set_settings(values)
+    current = get_limits()
+    with _limits_lock:
+        _limits, _limits_loaded_at = {**current, **values}, time.monotonic()
+    _limiter.reset()
+
+def reserve_tokens(key, username, prompt_tokens, model=""):
+    """Atomically reserve prompt tokens plus an output allowance against a key's quota.
+
+    Returns a Reservation, or None if the quota would be exceeded.
+    """
+    reserved = prompt_tokens + get_limits()["output_reserve_tokens"]
+    with get_cursor() as c:
+        row = c.execute('''
+            UPDATE api_keys SET used_tokens = used_tokens + ?
+            WHERE key = ? AND used_tokens + ? < total_tokens
+            RETURNING id
+        ''', (reserved, key, reserved)).fetchone()
+        if row:
+            return Reservation(key, row[0], username, model, prompt_tokens, reserved)
+        # Only the failure path pays for the extra lookup
+        if c.execute('SELECT 1 FROM api_keys WHERE key = ?', (key,)).fetchone():
+            return None
+    return Reservation(key, None, username, model, prompt_tokens, 0)
+
+def cached_prompt_tokens(usage):
+    """Prompt tokens served from the provider's context cache, if reported."""
+    # DeepSeek reports prompt_cache_hit_tokens; OpenAI-style APIs use prompt_tokens_details
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is None:
+        hit = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    return hit or 0
+
+def release_reservation(reservation):
+    """Refund a reservation for a request the provider never served; nothing is logged."""
+    if reservation.reserved:
+        with get_cursor() as c:
+            c.execute('''
+                UPDATE api_keys SET used_tokens = MAX(used_tokens - ?, 0)
+                WHERE key = ?
+            ''', (reservation.reserved, reservation.key))
+
+def settle_reservation(reservation, completion_tokens, usage=None):
+    """Replace the reserved amount with the tokens actually used and log them to the ledger.
+
+    Provider-reported usage, when the stream included it, takes precedence
+    over the local estimates.
+    """
+    prompt_tokens, cache_hit_tokens = reservation.prompt_tokens, 0
+    if usage is not None:
+        prompt_tokens = usage.prompt_tokens
+        completion_tokens = usage.completion_tokens
+        cache_hit_tokens = cached_prompt_tokens(usage)
+    delta = prompt_tokens + completion_tokens - reservation.reserved
+    if delta:
+        with get_cursor() as c:
+            c.execute('''
+                UPDATE api_keys SET used_tokens = MAX(used_tokens + ?, 0)
+                WHERE key = ?
+            ''', (delta, reservation.key))
+    record_usage(reservation.username, reservation.key_id, reservation.model,
+                 prompt_tokens, completion_tokens, cache_hit_tokens)
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until one token is available (0 if one is available now)."""
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """In-memory per-user and per-key request limiter shared by all sessions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def _bucket(self, scope, ident, per_minute, burst):
+        bucket = self._buckets.get((scope, ident))
+        if bucket is None:
+            bucket = self._buckets[(scope, ident)] = TokenBucket(per_minute / 60, max(burst, 1))
+        return bucket
+
+    def acquire(self, username, key):
+        """Take one request from both buckets; return 0 or the seconds to wait."""
+        limits = get_limits()
+        now = time.monotonic()
+        with self._lock:
+            buckets = [
+                self._bucket(scope, ident, limits[f"{scope}_requests_per_minute"], limits[f"{scope}_burst"])
+                for scope, ident in (("user", username), ("key", key))
+                if limits[f"{scope}_requests_per_minute"] > 0
+            ]
+            for bucket in buckets:
+                bucket.refill(now)
+            wait = max((bucket.wait_time() for bucket in buckets), default=0)
+            if not wait:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+            return wait
+
+_limiter = RateLimiter()
+
+def check_rate_limit(username, key):
+    """Return 0 if the request may proceed, else the seconds until it may."""
+    return _limiter.acquire(username, key)
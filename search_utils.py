@@ -0,0 +1,120 @@
+# search_utils.py
+import hashlib
+import json
+import logging
+import threading
+from db_utils import get_cursor, unpack_session_data
+
+# The trigram tokenizer needs at least three characters per term
+MIN_TERM_LENGTH = 3
+# Only the newest matches are ranked, which keeps common terms cheap on large histories
+MAX_RANKED_MATCHES = 2000
+# Sessions indexed per backfill transaction, so app writes are never blocked for long
+BACKFILL_BATCH_SIZE = 100
+
+_backfilled = False
+_backfill_thread = None
+_backfill_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+def _prefix_hash(messages):
+    """Fingerprint of the messages already in the index."""
+    return hashlib.md5(json.dumps(messages, ensure_ascii=False).encode()).hexdigest()
+
+def index_session_messages(c, username, session_id, messages):
+    """Add messages not yet in the search index for a session, using the caller's cursor."""
+    row = c.execute(
+        'SELECT indexed_count, indexed_hash FROM history WHERE session_id = ?', (session_id,)
+    ).fetchone()
+    start, indexed_hash = ((row[0] or 0), row[1]) if row else (0, None)
+    if start and (start > len(messages) or indexed_hash != _prefix_hash(messages[:start])):
+        # The session was rewritten rather than appended to; index it again
+        c.execute('DELETE FROM history_messages WHERE session_id = ?', (session_id,))
+        start = 0
+    c.executemany('''
+        INSERT INTO history_messages (session_id, username, msg_index, role, content)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        (session_id, username, i, m["role"], m["content"])
+        for i, m in enumerate(messages[start:], start)
+        if m["role"] != "system"
+    ])
+    c.execute(
+        'UPDATE history SET indexed_count = ?, indexed_hash = ? WHERE session_id = ?',
+        (len(messages), _prefix_hash(messages), session_id)
+    )
+
+def backfill_search_index():
+    """Index sessions saved before the search index existed, one batch per transaction."""
+    global _backfilled
+    last_id = 0
+    while True:
+        with get_cursor() as c:
+            c.execute('BEGIN IMMEDIATE')
+            pending = c.execute('''
+                SELECT id, username, session_id, session_data
+                FROM history
+                WHERE indexed_count = 0 AND session_data IS NOT NULL AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, BACKFILL_BATCH_SIZE)).fetchall()
+            for _, username, session_id, session_data in pending:
+                messages, _ = unpack_session_data(session_data)
+                index_session_messages(c, username, session_id, messages)
+        if not pending:
+            break
+        last_id = pending[-1][0]
+    # Only mark done once everything is indexed, so a failed run is retried
+    _backfilled = True
+
+def _backfill_loop():
+    try:
+        backfill_search_index()
+    except Exception:
+        logger.exception("Search index backfill failed")
+
+def start_search_backfill():
+    """Run the backfill on a background thread until it has succeeded once per process."""
+    global _backfill_thread
+    with _backfill_lock:
+        if _backfilled or (_backfill_thread is not None and _backfill_thread.is_alive()):
+            return
+        _backfill_thread = threading.Thread(target=_backfill_loop, name="search-backfill", daemon=True)
+        _backfill_thread.start()
+
+def _fts_query(query):
+    """Quote each term so user input is never parsed as FTS5 syntax."""
+    terms = [t for t in query.split() if len(t) >= MIN_TERM_LENGTH]
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+def search_history(username, query, limit=10):
+    """Return up to `limit` (session_id, session_name, snippet) tuples, best match first."""
+    match = _fts_query(query)
+    if not match:
+        return []
+    # snippet() cannot run in an aggregate, so rank the newest matches, pick each
+    # session's best message, then build snippets only for those rows
+    with get_cursor() as c:
+        return c.execute('''
+            WITH recent AS (
+                SELECT m.session_id, history_fts.rowid AS message_id, history_fts.rank AS score
+                FROM history_fts
+                JOIN history_messages m ON m.id = history_fts.rowid
+                WHERE history_fts MATCH ? AND m.username = ?
+                ORDER BY history_fts.rowid DESC
+                LIMIT ?
+            ), best AS (
+                SELECT session_id, message_id, MIN(score) AS score
+                FROM recent
+                GROUP BY session_id
+                ORDER BY score
+                LIMIT ?
+            )
+            SELECT best.session_id, h.session_name,
+                   snippet(history_fts, 0, '**', '**', '…', 12)
+            FROM best
+            CROSS JOIN history_fts ON history_fts.rowid = best.message_id
+            JOIN history h ON h.session_id = best.session_id
+            WHERE history_fts MATCH ?
+            ORDER BY best.score
+        ''', (match, username, MAX_RANKED_MATCHES, limit, match)).fetchall()
@@ -0,0 +1,340 @@
+# server.py
+"""Headless asyncio chat API alongside the Streamlit UI.
+
+Run with `python server.py`. Endpoints (all but login need `Authorization: Bearer <token>`):
+
+    POST /api/login               {"username", "password"} -> {"token"}
+    POST /api/chat                {"message", "session_id"?, "system_role"?, "web_search"?} -> SSE stream
+    POST /api/upload?session_id=  multipart files -> {"session_id", "documents"}
+    GET  /api/history             ?limit=&offset= -> sessions
+    GET  /api/history/{id}        -> messages and document names
+    GET  /api/search              ?q= -> ranked sessions with snippets
+"""
+import asyncio
+import json
+import os
+import secrets
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from aiohttp import web
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from db_utils import get_cursor
+from auth_utils import check_credentials, is_blacklisted
+from file_utils import parse_file, MAX_FILE_SIZE
+from api_utils import web_search, parse_chunk
+from prompt_utils import build_system_message, build_prompt_messages
+from quota_utils import (
+    check_rate_limit, reserve_tokens, settle_reservation, release_reservation, estimate_tokens
+)
+from helper_utils import store_session, fetch_session
+from search_utils import search_history
+from usage_utils import start_compactor, flush_usage
+
+load_dotenv()
+
+BASE_URL = "https://api.deepseek.com/v1"
+MODEL_NAME = "deepseek-reasoner"
+UPLOAD_DIR = "uploads/"
+
+# Concurrent upstream streams per process; further requests queue briefly, then get 503
+MAX_CONCURRENT_STREAMS = int(os.getenv("SERVER_MAX_STREAMS", 64))
+STREAM_QUEUE_TIMEOUT = 10
+# SQLite work runs on a small dedicated pool so the event loop never blocks on it
+DB_WORKERS = int(os.getenv("SERVER_DB_WORKERS", 8))
+# bcrypt, file parsing, prompt assembly and web search get their own pool so
+# slow CPU or network work never holds up SQLite calls
+WORK_WORKERS = int(os.getenv("SERVER_WORK_WORKERS", 16))
+TOKEN_TTL = 12 * 3600
+TOKEN_PRUNE_INTERVAL = 600
+
+API_KEY = os.getenv("DEEPSEEK_API_KEY")
+SEARCH_KEY = os.getenv("SEARCH_API_KEY")
+
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+work_executor = ThreadPoolExecutor(max_workers=WORK_WORKERS, thread_name_prefix="work")
+# Bearer token -> {"username", "is_admin", "expires"}
+tokens = {}
+# Bound to the server's event loop in on_startup
+client = None
+stream_slots = None
+token_pruner = None
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking SQLite call on the DB thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(
+        db_executor, partial(func, *args, **kwargs)
+    )
+
+async def run_work(func, *args, **kwargs):
+    """Run a blocking CPU or network call on the work thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(
+        work_executor, partial(func, *args, **kwargs)
+    )
+
+def json_error(status, message):
+    return web.json_response({"error": message}, status=status)
+
+async def read_json(request):
+    """Return the request body as a dict, or None if it is not a JSON object."""
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return None
+    return body if isinstance(body, dict) else None
+
+def string_fields(body, *names):
+    """Return the named fields as strings ('' when absent), or None if any is not a string."""
+    values = ["" if body.get(name) is None else body[name] for name in names]
+    return values if all(isinstance(v, str) for v in values) else None
+
+def prepare_prompt(messages, documents):
+    """Assemble the prompt and estimate its tokens; CPU-bound for large documents."""
+    prompt = build_prompt_messages(messages, documents)
+    return prompt, sum(estimate_tokens(m["content"]) for m in prompt)
+
+@web.middleware
+async def auth_middleware(request, handler):
+    if request.path == "/api/login":
+        return await handler(request)
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    session = tokens.get(token)
+    if not session or session["expires"] < time.time():
+        tokens.pop(token, None)
+        return json_error(401, "Invalid or expired token")
+    request["username"] = session["username"]
+    return await handler(request)
+
+async def login(request):
+    body = await read_json(request)
+    if body is None:
+        return json_error(400, "Request body must be a JSON object")
+    fields = string_fields(body, "username", "password")
+    if fields is None:
+        return json_error(400, "username and password must be strings")
+    username, password = fields
+    if await run_db(is_blacklisted, username):
+        return json_error(403, "Username is blacklisted")
+    # bcrypt is CPU-bound, keep it off the event loop and the DB pool
+    is_admin = await run_work(check_credentials, username, password)
+    if is_admin is None:
+        return json_error(401, "Invalid credentials")
+    token = secrets.token_urlsafe(32)
+    tokens[token] = {"username": username, "is_admin": is_admin, "expires": time.time() + TOKEN_TTL}
+    return web.json_response({"token": token, "is_admin": is_admin})
+
+async def load_owned_session(request, session_id):
+    """Return (messages, documents), or None if the session does not exist yet.
+
+    Sessions belonging to another user are reported as not found.
+    """
+    session = await run_db(fetch_session, session_id)
+    if session is None:
+        return None
+    if session[0] != request["username"]:
+        raise web.HTTPNotFound(reason="Session not found")
+    return session[1], session[2]
+
+async def upload(request):
+    session_id = request.query.get("session_id") or str(uuid.uuid4())
+    session = await load_owned_session(request, session_id)
+    messages, documents = session or ([build_system_message()], [])
+
+    reader = await request.multipart()
+    while part := await reader.next():
+        if not part.filename:
+            continue
+        # Stream the part so oversized files are rejected before being buffered
+        chunks, size = [], 0
+        while chunk := await part.read_chunk():
+            size += len(chunk)
+            if size > MAX_FILE_SIZE:
+                return json_error(413, f"File {part.filename} exceeds size limit.")
+            chunks.append(chunk)
+        try:
+            info = await run_work(parse_file, UPLOAD_DIR, part.filename, b"".join(chunks))
+        except Exception as e:
+            return json_error(400, f"Failed to parse file {part.filename}: {e}")
+        if not any(f["hash"] == info["hash"] for f in documents):
+            documents.append(info)
+
+    await run_db(store_session, request["username"], session_id, messages, documents)
+    return web.json_response({"session_id": session_id, "documents": [f["name"] for f in documents]})
+
+async def send_event(response, event, data):
+    await response.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+
+async def chat(request):
+    body = await read_json(request)
+    if body is None:
+        return json_error(400, "Request body must be a JSON object")
+    fields = string_fields(body, "message", "session_id", "system_role")
+    if fields is None:
+        return json_error(400, "message, session_id and system_role must be strings")
+    user_input, session_id, system_role = fields
+    username = request["username"]
+    user_input = user_input.strip()
+    if not user_input:
+        return json_error(400, "Message is required")
+
+    # Limits are refreshed from the DB periodically, so keep this off the loop too
+    if wait := await run_db(check_rate_limit, username, API_KEY):
+        return json_error(429, f"Too many requests, please retry in {wait:.0f} seconds.")
+
+    session_id = session_id or str(uuid.uuid4())
+    session = await load_owned_session(request, session_id)
+    messages, documents = session or ([build_system_message(system_role)], [])
+
+    user_content = [user_input]
+    if body.get("web_search") and SEARCH_KEY:
+        user_content.insert(0, await run_work(web_search, user_input, SEARCH_KEY))
+    messages.append({"role": "user", "content": "\n".join(user_content)})
+
+    prompt, prompt_tokens = await run_work(prepare_prompt, messages, documents)
+
+    try:
+        await asyncio.wait_for(stream_slots.acquire(), STREAM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return json_error(503, "Server busy, please retry later")
+    try:
+        reservation = await run_db(reserve_tokens, API_KEY, username, prompt_tokens, MODEL_NAME)
+        if reservation is None:
+            return json_error(402, "Quota exhausted, please contact the admin.")
+
+        # Everything after the reservation settles it, whatever fails
+        total_content, total_count, usage, received = "", 0, None, False
+        try:
+            response = web.StreamResponse(headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "X-Session-Id": session_id,
+            })
+            await response.prepare(request)
+
+            try:
+                stream = await client.chat.completions.create(
+                    model=MODEL_NAME,
+                    messages=prompt,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    max_tokens=32768
+                )
+                async for chunk in stream:
+                    received = True
+                    reasoning, content, chunk_usage = parse_chunk(chunk)
+                    usage = chunk_usage or usage
+                    total_count += estimate_tokens(reasoning + content)
+                    if reasoning:
+                        await send_event(response, "reasoning", reasoning)
+                    if content:
+                        total_content += content
+                        await send_event(response, "content", content)
+            except Exception as e:
+                if not request.transport or request.transport.is_closing():
+                    raise
+                await send_event(response, "error", str(e))
+                return response
+        finally:
+            if received:
+                await run_db(settle_reservation, reservation, total_count, usage)
+            else:
+                # Upstream never answered: refund and keep it out of the ledger
+                await run_db(release_reservation, reservation)
+
+        messages.append({"role": "assistant", "content": total_content})
+        await run_db(store_session, username, session_id, messages, documents)
+        await send_event(response, "done", {
+            "session_id": session_id,
+            "usage": usage.model_dump() if usage is not None else None,
+        })
+        await response.write_eof()
+        return response
+    finally:
+        stream_slots.release()
+
+async def list_history(request):
+    try:
+        limit = int(request.query.get("limit", 20))
+        offset = int(request.query.get("offset", 0))
+    except ValueError:
+        return json_error(400, "limit and offset must be integers")
+    limit, offset = max(1, min(limit, 100)), max(0, offset)
+
+    def query():
+        with get_cursor() as c:
+            return c.execute('''
+                SELECT session_id, session_name, updated_at
+                FROM history
+                WHERE username = ?
+                ORDER BY updated_at DESC
+                LIMIT ? OFFSET ?
+            ''', (request["username"], limit, offset)).fetchall()
+
+    rows = await run_db(query)
+    return web.json_response([
+        {"session_id": r[0], "session_name": r[1], "updated_at": r[2]} for r in rows
+    ])
+
+async def get_history(request):
+    session = await load_owned_session(request, request.match_info["session_id"])
+    if session is None:
+        return json_error(404, "Session not found")
+    messages, documents = session
+    return web.json_response({
+        "messages": [m for m in messages if m["role"] != "system"],
+        "documents": [f["name"] for f in documents],
+    })
+
+async def search(request):
+    results = await run_db(search_history, request["username"], request.query.get("q", ""))
+    return web.json_response([
+        {"session_id": r[0], "session_name": r[1], "snippet": r[2]} for r in results
+    ])
+
+async def prune_tokens():
+    """Drop expired bearer tokens that were never presented again."""
+    while True:
+        await asyncio.sleep(TOKEN_PRUNE_INTERVAL)
+        now = time.time()
+        for token in [t for t, session in tokens.items() if session["expires"] < now]:
+            del tokens[token]
+
+async def on_startup(app):
+    global client, stream_slots, token_pruner
+    client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL)
+    stream_slots = asyncio.Semaphore(MAX_CONCURRENT_STREAMS)
+    token_pruner = asyncio.create_task(prune_tokens())
+    start_compactor()
+
+async def on_cleanup(app):
+    token_pruner.cancel()
+    await client.close()
+    await run_db(flush_usage)
+    work_executor.shutdown(wait=True)
+    db_executor.shutdown(wait=True)
+
+def create_app():
+    app = web.Application(middlewares=[auth_middleware], client_max_size=MAX_FILE_SIZE * 5)
+    app.add_routes([
+        web.post("/api/login", login),
+        web.post("/api/chat", chat),
+        web.post("/api/upload", upload),
+        web.get("/api/history", list_history),
+        web.get("/api/history/{session_id}", get_history),
+        web.get("/api/search", search),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+if __name__ == "__main__":
+    if not API_KEY:
+        raise SystemExit("API key not found. Please check your .env file.")
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    web.run_app(
+        create_app(),
+        host=os.getenv("SERVER_HOST", "127.0.0.1"),
+        port=int(os.getenv("SERVER_PORT", 8000))
+    )
@@ -0,0 +1,110 @@
+# usage_utils.py
+import atexit
+import logging
+import threading
+import time
+from db_utils import get_cursor
+
+# The compactor is woken early once this many events are pending
+FLUSH_BATCH_SIZE = 50
+# Seconds between background flush + rollup passes
+COMPACT_INTERVAL = 60
+
+ROLLUPS = {
+    "usage_hourly": "%Y-%m-%d %H:00",
+    "usage_daily": "%Y-%m-%d",
+}
+
+_pending = []
+_pending_lock = threading.Lock()
+_compactor = None
+_compactor_lock = threading.Lock()
+_flush_wanted = threading.Event()
+logger = logging.getLogger(__name__)
+
+def record_usage(username, key_id, model, prompt_tokens, completion_tokens, cache_hit_tokens=0):
+    """Queue one usage event for the ledger.
+
+    Never touches the DB: the compactor thread writes the buffer in batches.
+    """
+    event = (int(time.time()), username or "", key_id, model or "",
+             prompt_tokens, completion_tokens, cache_hit_tokens)
+    with _pending_lock:
+        _pending.append(event)
+        full = len(_pending) >= FLUSH_BATCH_SIZE
+    if full:
+        _flush_wanted.set()
+
+def flush_usage():
+    """Write all buffered events to usage_events in one transaction."""
+    global _pending
+    with _pending_lock:
+        batch, _pending = _pending, []
+    if not batch:
+        return
+    try:
+        with get_cursor() as c:
+            c.executemany('''
+                INSERT INTO usage_events
+                    (created_at, username, key_id, model,
+                     prompt_tokens, completion_tokens, cache_hit_tokens)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+    except Exception:
+        # Keep the events for the next attempt rather than losing them
+        with _pending_lock:
+            _pending = batch + _pending
+        raise
+
+def compact_usage():
+    """Fold ledger events newer than the watermark into the hourly and daily rollups."""
+    with get_cursor() as c:
+        # Take the write lock before reading the watermark so concurrent
+        # compactors (Streamlit and server.py) never fold the same range twice
+        c.execute('BEGIN IMMEDIATE')
+        row = c.execute("SELECT value FROM app_settings WHERE name = 'usage_compacted_id'").fetchone()
+        start = int(row[0]) if row else 0
+        end = c.execute('SELECT MAX(id) FROM usage_events').fetchone()[0] or 0
+        if end <= start:
+            return
+        for table, fmt in ROLLUPS.items():
+            c.execute(f'''
+                INSERT INTO {table} (bucket, username, model, requests,
+                                     prompt_tokens, completion_tokens, cache_hit_tokens)
+                SELECT strftime('{fmt}', created_at, 'unixepoch'), username, model,
+                       COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cache_hit_tokens)
+                FROM usage_events
+                WHERE id > ? AND id <= ?
+                GROUP BY 1, 2, 3
+                ON CONFLICT(bucket, username, model) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    cache_hit_tokens = cache_hit_tokens + excluded.cache_hit_tokens
+            ''', (start, end))
+        c.execute('''
+            INSERT INTO app_settings (name, value) VALUES ('usage_compacted_id', ?)
+            ON CONFLICT(name) DO UPDATE SET
+                value = excluded.value,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (str(end),))
+
+def _compact_loop():
+    while True:
+        _flush_wanted.wait(COMPACT_INTERVAL)
+        _flush_wanted.clear()
+        try:
+            flush_usage()
+            compact_usage()
+        except Exception:
+            logger.exception("Usage compaction failed")
+
+def start_compactor():
+    """Start the background flush/rollup thread once per process."""
+    global _compactor
+    with _compactor_lock:
+        if _compactor is None:
+            _compactor = threading.Thread(target=_compact_loop, name="usage-compactor", daemon=True)
+            _compactor.start()
+
+atexit.register(flush_usage)